@@ -1,64 +1,61 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Callable, Optional
 from typing_extensions import List
-import math
+import mmap
 import os
-from itertools import chain
-from functools import cmp_to_key
+import struct
+import sys
 
 NAME_LEN = 70
 ADDR_LEN = 15
 
+# per-file header record: address, size, path length
+HDR = struct.Struct("<III")
 
-@dataclass
+# map '_' to the max code point so translated names sort it after everything
+UNDERSCORE_LAST = str.maketrans({"_": "\U0010ffff"})
+
+PREFIXES = ("B", "KiB", "MiB", "GiB")
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (OSError, ValueError):
+    IOV_MAX = 1024
+
+
+@dataclass(slots=True)
 class Reader:
-    data: bytearray
+    data: memoryview
     ptr: int = 0
 
+    def __post_init__(self):
+        # normalise whatever buffer the caller passed (bytes, bytearray, mmap)
+        # so every slice below is a zero-copy view
+        self.data = memoryview(self.data)
+
     def read_le(self, count: int) -> int:
-        return sum(0x100**i * v for i, v in enumerate(self.read_bytes(count)))
+        return int.from_bytes(self.read_bytes(count), "little")
 
     def read_str(self, length_count: int) -> str:
         length = self.read_le(length_count)
         raw_string = self.read_bytes(length)
-        return raw_string.decode("utf-8")
+        return bytes(raw_string).decode("utf-8")
 
-    def read_bytes(self, count: int) -> bytearray:
+    def read_bytes(self, count: int) -> memoryview:
         val = self.data[self.ptr : self.ptr + count]
         self.ptr += count
         return val
 
-    def bytes_at(self, addr: int, count: int) -> bytearray:
+    def bytes_at(self, addr: int, count: int) -> memoryview:
         return self.data[addr : addr + count]
 
     def assertion(self, data: bytes, reason: str):
         assert self.read_bytes(len(data)) == data, reason
 
 
-def fmap[T, U](f: Callable[[T], U], opt: Optional[T]) -> Optional[U]:
-    return f(opt) if opt is not None else None
-
-
-@dataclass
-class Writer:
-    data: bytearray = field(default_factory=lambda: bytearray(b""))
-
-    def write_le(self, value: int, length: int, at: Optional[int] = None):
-        self.write_bytes(value.to_bytes(length, byteorder="little"), at)
-
-    def write_str(self, string: str, length_count: int, at: Optional[int] = None):
-        self.write_le(len(string), length_count, at)
-        self.write_bytes(string.encode(), fmap(lambda x: x + 4, at))
-
-    def write_bytes(self, data: bytes, at: Optional[int] = None):
-        if at == None:
-            self.data += data
-        else:
-            self.data[at : len(data) + at] = data
-
-
 parser = argparse.ArgumentParser(
     prog="wak", description="Compress and Decompress wak files"
 )
@@ -102,23 +99,33 @@ if args.verbose:
 
 
 def prettify_bytes(num: int) -> str:
-    prefixes = ["B", "KiB", "MiB", "GiB"]
     if num == 0:
         return "0B"
-    category = math.floor(math.log(num, 1024))
-    num /= 1024**category
-    num_str = f"{num:.0f}" if category == 0 else f"{num:.2f}"
-    return f"{num_str}{prefixes[category]}"
+    category = min((num.bit_length() - 1) // 10, len(PREFIXES) - 1)
+    scaled = num / (1 << (10 * category))
+    num_str = f"{scaled:.0f}" if category == 0 else f"{scaled:.2f}"
+    return f"{num_str}{PREFIXES[category]}"
 
 
-@dataclass
+@dataclass(slots=True)
 class File:
     path: str
-    content: bytes
+    addr: int
+    size: int
+
+
+@dataclass(slots=True)
+class SourceFile:
+    path: str
+    source: Path
+    size: int
 
 
 def parse_wak(wak: Path, verbose: bool) -> List[File]:
-    reader = Reader(data=bytearray(open(wak, "rb").read()))
+    fd = os.open(wak, os.O_RDONLY)
+    mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    os.close(fd)
+    reader = Reader(data=mm)
     reader.assertion(b"\0\0\0\0", "header start")
     file_count = reader.read_le(4)
     first_file = reader.read_le(4)
@@ -132,101 +139,145 @@ def parse_wak(wak: Path, verbose: bool) -> List[File]:
 
     files: List[File] = []
 
+    data = reader.data
+    ptr = reader.ptr
+    unpack_from = HDR.unpack_from
+    hdr_size = HDR.size
+    append = files.append
     for _ in range(file_count):
-        addr = reader.read_le(4)
-        size = reader.read_le(4)
-        path = reader.read_str(4)
-        content = reader.bytes_at(addr, size)
-        files.append(File(path, bytes(content)))
+        addr, size, path_len = unpack_from(data, ptr)
+        ptr += hdr_size
+        path = bytes(data[ptr : ptr + path_len]).decode("utf-8")
+        ptr += path_len
+        append(File(path, addr, size))
         display(path, hex(addr), prettify_bytes(size))
+    reader.ptr = ptr
+
+    # only the header table is ever read through the map; release it so
+    # extraction doesn't keep the whole archive mapped
+    reader.data.release()
+    mm.close()
 
     return files
 
 
-def cmp_to_cmp[T](fn: Callable[[T, T], bool]) -> Callable[[T, T], int]:
-    return lambda a, b: -1 if fn(a, b) else (1 if fn(b, a) else 0)
-
-
-def str_gt(a: str, b: str) -> bool:
-    if len(a) == 0 or len(b) == 0:
-        return a > b
-    if a[0] == "_" and b[0] != "_":
-        return True
-    if a[0] != "_" and b[0] == "_":
-        return False
-    if a[0] == b[0]:
-        return str_gt(a[1:], b[1:])
-    return a > b
-
-
-def dir_to_files(dir: Path, verbose: bool) -> List[File]:
-
-    def path_cmp(a: Path, b: Path) -> bool:
-        if a.is_dir() and not b.is_dir():
-            return False
-        if b.is_dir() and not a.is_dir():
-            return True
-        return str_gt(str(b), str(a))
-
-    def impl(root: Path, dir: Path, verbose: bool) -> List[File]:
-        return list(
-            chain.from_iterable(
-                [
-                    (
-                        impl(root, x, verbose)
-                        if x.is_dir()
-                        else [
-                            File(
-                                str(x.relative_to(root)),
-                                open(x, "rb").read(),
-                            )
-                        ]
-                    )
-                    for x in sorted(
-                        (dir / y for y in os.listdir(dir)),
-                        key=cmp_to_key(cmp_to_cmp(path_cmp)),
-                    )
-                ]
+def dir_to_files(dir: Path, verbose: bool) -> List[SourceFile]:
+
+    def name_key(name: str) -> str:
+        # '_' sorts after every other character
+        return name.translate(UNDERSCORE_LAST)
+
+    def raise_error(error: OSError):
+        # os.walk swallows scandir failures by default; an unreadable or
+        # missing directory must not silently vanish from the archive
+        raise error
+
+    files: List[SourceFile] = []
+    # sorting dirnames in place steers the walk, so the depth-first order
+    # (files of a dir first, then each subdir) matches the old traversal
+    for dirpath, dirnames, filenames in os.walk(dir, onerror=raise_error):
+        dirnames.sort(key=name_key)
+        filenames.sort(key=name_key)
+        for name in filenames:
+            source = Path(dirpath) / name
+            files.append(
+                SourceFile(
+                    str(source.relative_to(dir)),
+                    source,
+                    source.stat().st_size,
+                )
             )
-        )
-
-    return impl(dir, dir, verbose)
-
 
-def write_file_header(writer: Writer, start: int, file: File, verbose: bool):
-    writer.write_le(start, 4)
-    writer.write_le(len(file.content), 4)
-    writer.write_str(file.path, 4)
-
-
-def write_file_content(writer: Writer, file: File, verbose: bool):
-    writer.write_bytes(file.content)
-    writer.write_bytes(b"\0")
+    return files
 
 
-def save_wak(wak: Path, files: List[File], verbose: bool):
-    writer = Writer()
-    if args.verbose:
+def save_wak(wak: Path, files: List[SourceFile], verbose: bool):
+    if verbose:
         for file in files:
-            print(f"{file.path:<{NAME_LEN}} {prettify_bytes(len(file.content))}")
+            print(f"{file.path:<{NAME_LEN}} {prettify_bytes(file.size)}")
 
+    # one C-level encode covers every path; NUL can't appear in a path, so
+    # splitting on it recovers the per-path byte strings
+    joined = "\0".join(file.path for file in files).encode("utf-8")
+    paths = joined.split(b"\0") if files else []
     # (header start + n files + first addr + header end) + addr + size + len
-    start_offset = 16 + sum(12 + len(file.path) for file in files)
+    start_offset = 16 + sum(12 + len(path) for path in paths)
     if verbose:
         print(hex(start_offset))
 
-    writer.write_bytes(b"\0\0\0\0")
-    writer.write_le(len(files), 4)
-    writer.write_le(start_offset, 4)
-    writer.write_bytes(b"\0\0\0\0")
-
-    for file in files:
-        write_file_header(writer, start_offset, file, verbose)
-        start_offset += len(file.content) + 1
-    for file in files:
-        write_file_content(writer, file, verbose)
-
-    open(wak, "wb").write(writer.data)
+    with open(wak, "wb", buffering=1 << 20) as out:
+        # the zero pads at 0 and 12 are already zero in the fresh bytearray
+        header = bytearray(start_offset)
+        header[4:8] = len(files).to_bytes(4, "little")
+        header[8:12] = start_offset.to_bytes(4, "little")
+        off = 16
+        for file, path_bytes in zip(files, paths):
+            HDR.pack_into(header, off, start_offset, file.size, len(path_bytes))
+            off += HDR.size
+            header[off : off + len(path_bytes)] = path_bytes
+            off += len(path_bytes)
+            start_offset += file.size + 1
+        out.write(header)
+
+        def read_content(file: SourceFile) -> bytes:
+            with open(file.source, "rb") as src:
+                content = src.read()
+            # the header offsets were computed from the walk-time stat sizes,
+            # so a file changing size since then corrupts every later entry
+            if len(content) != file.size:
+                raise Exception(f"{file.path} changed size during archiving")
+            return content
+
+        out.flush()
+        fd = out.fileno()
+        use_writev = hasattr(os, "writev")
+
+        def write_all(buf: bytes):
+            view = memoryview(buf)
+            while view:
+                view = view[os.write(fd, view) :]
+
+        # contents and their NUL terminators are gathered into one writev per
+        # batch, cutting the write syscalls from two per file to two per
+        # ~IOV_MAX files; the byte cap keeps memory bounded for large files
+        batch: List[bytes] = []
+        batch_size = 0
+
+        def flush_batch():
+            nonlocal batch_size
+            if not batch:
+                return
+            if use_writev:
+                written = os.writev(fd, batch)
+                if written != batch_size:  # short write, finish the tail
+                    write_all(b"".join(batch)[written:])
+            else:
+                write_all(b"".join(batch))
+            batch.clear()
+            batch_size = 0
+
+        def drain_one():
+            nonlocal batch_size
+            content = pending.popleft().result()
+            batch.append(content)
+            batch.append(b"\0")
+            batch_size += len(content) + 1
+            if len(batch) + 1 > IOV_MAX or batch_size >= 1 << 25:
+                flush_batch()
+
+        # reads overlap in threads (the GIL is released during read) but are
+        # drained in submit order; the window bound keeps memory at
+        # O(window * file size) rather than the whole archive
+        max_workers = min(32, (os.cpu_count() or 1) * 4)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            pending: deque = deque()
+            for file in files:
+                pending.append(pool.submit(read_content, file))
+                if len(pending) > 2 * max_workers:
+                    drain_one()
+            while pending:
+                drain_one()
+            flush_batch()
 
 
 if args.compress:
@@ -234,7 +285,32 @@ if args.compress:
     save_wak(args.wak, files, args.verbose)
 else:
     files = parse_wak(args.wak, args.verbose)
-    for file in files:
-        path = args.dir / file.path
-        os.makedirs(path.parent, exist_ok=True)
-        open(path, "wb").write(file.content)
+    for parent in sorted({(args.dir / file.path).parent for file in files}):
+        os.makedirs(parent, exist_ok=True)
+    # only Linux sendfile accepts a regular file as the destination; on
+    # macOS/FreeBSD it exists but wants a socket, so gate on the platform
+    use_sendfile = sys.platform == "linux"
+    with open(args.wak, "rb") as src:
+        for file in files:
+            path = args.dir / file.path
+            with open(path, "wb") as out:
+                if use_sendfile:
+                    # sendfile caps each call (~2 GiB on Linux) and may return
+                    # short, so loop until the whole range is copied
+                    offset = file.addr
+                    left = file.size
+                    while left > 0:
+                        sent = os.sendfile(out.fileno(), src.fileno(), offset, left)
+                        if sent == 0:
+                            raise Exception(f"wak truncated while extracting {file.path}")
+                        offset += sent
+                        left -= sent
+                else:
+                    src.seek(file.addr)
+                    left = file.size
+                    while left > 0:
+                        chunk = src.read(min(left, 1 << 20))
+                        if not chunk:
+                            break
+                        out.write(chunk)
+                        left -= len(chunk)